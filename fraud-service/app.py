@@ -1,50 +1,148 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request
+import msgpack
+import orjson
 import redis
-import json
-import numpy as np
-from datetime import datetime, timedelta
+from cachetools import TTLCache
+import uuid
+import random
+from datetime import datetime
 import logging
+import socket
+import threading
+import time
 
 app = Flask(__name__)
 app.logger.setLevel(logging.INFO)
 
 # Redis connection
+# Probe idle sockets after 60s, every 10s, and drop them after 3 misses.
+# getattr keeps this importable on platforms without the Linux constants.
+KEEPALIVE_OPTIONS = {
+    option: value
+    for option, value in (
+        (getattr(socket, 'TCP_KEEPIDLE', None), 60),
+        (getattr(socket, 'TCP_KEEPINTVL', None), 10),
+        (getattr(socket, 'TCP_KEEPCNT', None), 3)
+    )
+    if option is not None
+}
+
+def create_redis_client(host):
+    # Blocking pool so a burst of greenlets waits for a free connection
+    # instead of failing once max_connections is reached
+    pool = redis.BlockingConnectionPool(
+        host=host,
+        port=6379,
+        decode_responses=True,
+        max_connections=64,
+        timeout=5,
+        socket_keepalive=True,
+        socket_keepalive_options=KEEPALIVE_OPTIONS,
+        health_check_interval=30
+    )
+    return redis.Redis(connection_pool=pool)
+
 try:
-    redis_client = redis.Redis(host='redis', port=6379, decode_responses=True)
+    redis_client = create_redis_client('redis')
 except:
     # Fallback for development
-    redis_client = redis.Redis(host='localhost', port=6379, decode_responses=True)
+    redis_client = create_redis_client('localhost')
+
+PATTERN_ROUND_AMOUNT = 1
+PATTERN_UNUSUAL_TIME = 2
+
+def pattern_flags(amount, hour):
+    # Bitmask of pattern anomalies: round amounts (potential automation) and
+    # off-hours activity
+    return (
+        (amount > 100 and amount % 100 == 0) * PATTERN_ROUND_AMOUNT
+        | (hour < 6 or hour > 22) * PATTERN_UNUSUAL_TIME
+    )
+
+def parse_timestamp(value):
+    # datetime for an ISO 8601 string, or None when it can't be parsed.
+    # fromisoformat only accepts a trailing 'Z' from Python 3.11.
+    if not isinstance(value, str):
+        return None
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+def parse_tx_hour(transaction_data, now_ts):
+    if 'timestamp' in transaction_data:
+        return parse_timestamp(transaction_data['timestamp']).hour
+    return time.localtime(now_ts).tm_hour
+
+# (second, ISO string) of the last formatted response timestamp, so the
+# string is built once per second rather than once per response
+_timestamp_cache = (0, '')
+
+def now_iso(now_ts):
+    global _timestamp_cache
+    second = int(now_ts)
+    cached_second, cached_iso = _timestamp_cache
+    if cached_second != second:
+        cached_iso = datetime.fromtimestamp(second).isoformat()
+        _timestamp_cache = (second, cached_iso)
+    return cached_iso
+
+def parse_location(location):
+    # (longitude, latitude) for a {lat, lng} location Redis can index, else None
+    try:
+        longitude = float(location['lng'])
+        latitude = float(location['lat'])
+    except (TypeError, KeyError, ValueError):
+        return None
+    if -180 <= longitude <= 180 and -85.05112878 <= latitude <= 85.05112878:
+        return longitude, latitude
+    return None
+
+class Transaction:
+    # Fields the checks read, extracted once from the request JSON
+    __slots__ = ('data', 'user_id', 'amount', 'hour', 'location', 'coordinates')
+    
+    def __init__(self, transaction_data, now_ts):
+        self.data = transaction_data
+        self.user_id = transaction_data.get('fromUser')
+        self.amount = transaction_data.get('amount', 0)
+        self.hour = parse_tx_hour(transaction_data, now_ts)
+        self.location = transaction_data.get('location')
+        self.coordinates = parse_location(self.location)
+
+VELOCITY_THRESHOLD = 10  # transactions per hour
+AMOUNT_THRESHOLD = 1000  # suspicious amount threshold
+LOCATION_RADIUS_KM = 50  # km radius for location anomaly
 
 class FraudDetector:
-    def __init__(self):
-        self.velocity_threshold = 10  # transactions per hour
-        self.amount_threshold = 1000  # suspicious amount threshold
-        self.location_radius = 50  # km radius for location anomaly
-        
-    def analyze_transaction(self, transaction_data):
+    __slots__ = ()
+    
+    def analyze_transaction(self, transaction, context, now_ts):
         alerts = []
         risk_score = 0
         
         # Velocity check
-        velocity_alert = self.check_velocity(transaction_data)
+        velocity_alert = self.check_velocity(transaction, context)
         if velocity_alert:
             alerts.append(velocity_alert)
             risk_score += 30
             
         # Amount anomaly check
-        amount_alert = self.check_amount_anomaly(transaction_data)
+        amount_alert = self.check_amount_anomaly(transaction, context)
         if amount_alert:
             alerts.append(amount_alert)
             risk_score += 25
             
         # Location check
-        location_alert = self.check_location_anomaly(transaction_data)
+        location_alert = self.check_location_anomaly(transaction, context)
         if location_alert:
             alerts.append(location_alert)
             risk_score += 20
             
         # Pattern analysis
-        pattern_alert = self.check_pattern_anomaly(transaction_data)
+        pattern_alert = self.check_pattern_anomaly(transaction)
         if pattern_alert:
             alerts.append(pattern_alert)
             risk_score += 15
@@ -52,44 +150,49 @@ class FraudDetector:
         return {
             'risk_score': min(risk_score, 100),
             'alerts': alerts,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': now_iso(now_ts)
         }
     
-    def check_velocity(self, transaction_data):
-        user_id = transaction_data.get('fromUser')
-        current_time = datetime.now()
-        hour_ago = current_time - timedelta(hours=1)
-        
-        # Get recent transactions from Redis
-        recent_key = f"user_transactions:{user_id}"
-        recent_transactions = redis_client.zrangebyscore(
-            recent_key, 
-            hour_ago.timestamp(), 
-            current_time.timestamp()
-        )
-        
-        if len(recent_transactions) > self.velocity_threshold:
+    def score_only(self, transaction, context):
+        # Same rules as analyze_transaction, without building alert details
+        amount = transaction.amount
+        historical_avg = context.get('historical_avg')
+        
+        velocity_flag = context.get('recent_count', 0) > VELOCITY_THRESHOLD
+        if historical_avg:
+            amount_flag = amount > historical_avg * 5
+        else:
+            amount_flag = amount > AMOUNT_THRESHOLD
+        location_flag = context.get('location_anomaly', False)
+        pattern_flag = pattern_flags(amount, transaction.hour) != 0
+        
+        risk_score = 30 * velocity_flag + 25 * amount_flag + 20 * location_flag + 15 * pattern_flag
+        return min(risk_score, 100)
+    
+    def check_velocity(self, transaction, context):
+        # Recent transaction count is prefetched by the /analyze route
+        recent_count = context.get('recent_count', 0)
+        
+        if recent_count > VELOCITY_THRESHOLD:
             return {
                 'type': 'velocity',
-                'severity': 'high' if len(recent_transactions) > 15 else 'medium',
-                'description': f'High transaction velocity: {len(recent_transactions)} in the last hour',
+                'severity': 'high' if recent_count > 15 else 'medium',
+                'description': f'High transaction velocity: {recent_count} in the last hour',
                 'metadata': {
-                    'transaction_count': len(recent_transactions),
-                    'threshold': self.velocity_threshold
+                    'transaction_count': recent_count,
+                    'threshold': VELOCITY_THRESHOLD
                 }
             }
         return None
     
-    def check_amount_anomaly(self, transaction_data):
-        amount = transaction_data.get('amount', 0)
-        user_id = transaction_data.get('fromUser')
+    def check_amount_anomaly(self, transaction, context):
+        amount = transaction.amount
         
-        # Get user's historical average
-        avg_key = f"user_avg_amount:{user_id}"
-        historical_avg = redis_client.get(avg_key)
+        # User's historical average, prefetched by the /analyze route
+        historical_avg = context.get('historical_avg')
         
         if historical_avg:
-            avg_amount = float(historical_avg)
+            avg_amount = historical_avg
             if amount > avg_amount * 5:  # 5x average
                 return {
                     'type': 'amount',
@@ -101,45 +204,40 @@ class FraudDetector:
                         'multiplier': amount / avg_amount
                     }
                 }
-        elif amount > self.amount_threshold:
+        elif amount > AMOUNT_THRESHOLD:
             return {
                 'type': 'amount',
                 'severity': 'medium',
                 'description': f'Large transaction amount: ${amount}',
                 'metadata': {
                     'amount': amount,
-                    'threshold': self.amount_threshold
+                    'threshold': AMOUNT_THRESHOLD
                 }
             }
         return None
     
-    def check_location_anomaly(self, transaction_data):
-        # Mock location check - in reality, would use geolocation data
-        user_id = transaction_data.get('fromUser')
-        location = transaction_data.get('location')
-        
-        if location:
-            # Simulate location anomaly detection
-            if np.random.random() > 0.8:  # 20% chance of location anomaly
-                return {
-                    'type': 'location',
-                    'severity': 'medium',
-                    'description': 'Transaction from unusual location',
-                    'metadata': {
-                        'current_location': location,
-                        'usual_locations': ['Lagos', 'Abuja']  # Mock usual locations
-                    }
+    def check_location_anomaly(self, transaction, context):
+        # Set by the /analyze route when none of the user's previous locations
+        # are within LOCATION_RADIUS_KM of this one
+        if context.get('location_anomaly'):
+            return {
+                'type': 'location',
+                'severity': 'medium',
+                'description': 'Transaction from unusual location',
+                'metadata': {
+                    'current_location': transaction.location,
+                    'radius_km': LOCATION_RADIUS_KM
                 }
+            }
         return None
     
-    def check_pattern_anomaly(self, transaction_data):
+    def check_pattern_anomaly(self, transaction):
         # Simple pattern analysis
-        transaction_type = transaction_data.get('type')
-        amount = transaction_data.get('amount', 0)
-        timestamp = datetime.fromisoformat(transaction_data.get('timestamp', datetime.now().isoformat()))
+        amount = transaction.amount
+        flags = pattern_flags(amount, transaction.hour)
         
         # Check for round number amounts (potential automation)
-        if amount % 100 == 0 and amount > 100:
+        if flags & PATTERN_ROUND_AMOUNT:
             return {
                 'type': 'pattern',
                 'severity': 'low',
@@ -151,13 +249,13 @@ class FraudDetector:
             }
         
         # Check for off-hours transactions
-        if timestamp.hour < 6 or timestamp.hour > 22:
+        if flags & PATTERN_UNUSUAL_TIME:
             return {
                 'type': 'pattern',
                 'severity': 'low',
                 'description': 'Transaction during unusual hours',
                 'metadata': {
-                    'hour': timestamp.hour,
+                    'hour': transaction.hour,
                     'pattern_type': 'unusual_time'
                 }
             }
@@ -166,72 +264,288 @@ class FraudDetector:
 
 detector = FraudDetector()
 
+# Records a transaction and returns the inputs the checks need in one
+# round-trip: {transactions in the velocity window, amount sum, amount count},
+# with the sum and count taken before this transaction so its own amount
+# doesn't skew the average it is compared against. The transaction itself is
+# kept msgpack-encoded in a capped list of the user's last 100.
+# When a location is given, the 4th value is 1 if the user has known
+# locations and none are within the radius, and the location is then added.
+# KEYS: recent transactions zset, amount stats hash, transaction history list,
+#       known locations geo set
+# ARGV: timestamp, velocity window start, amount, transaction id, packed transaction,
+#       longitude, latitude, location member, radius in km ('' when no location)
+# Redis doesn't roll back a script that fails partway, so the amount is
+# checked before anything is written.
+RECORD_TRANSACTION_LUA = """
+if not tonumber(ARGV[3]) then
+    return redis.error_reply('amount must be a number')
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+redis.call('EXPIRE', KEYS[1], 86400)
+local count = redis.call('ZCOUNT', KEYS[1], ARGV[2], ARGV[1])
+local stats = redis.call('HMGET', KEYS[2], 'sum', 'count')
+redis.call('HINCRBYFLOAT', KEYS[2], 'sum', ARGV[3])
+redis.call('HINCRBY', KEYS[2], 'count', 1)
+redis.call('EXPIRE', KEYS[2], 2592000)
+redis.call('RPUSH', KEYS[3], ARGV[5])
+redis.call('LTRIM', KEYS[3], -100, -1)
+redis.call('EXPIRE', KEYS[3], 2592000)
+local location_anomaly = 0
+if ARGV[6] ~= '' then
+    if redis.call('EXISTS', KEYS[4]) == 1 then
+        local nearby = redis.call('GEOSEARCH', KEYS[4], 'FROMLONLAT', ARGV[6], ARGV[7],
+            'BYRADIUS', ARGV[9], 'km', 'COUNT', 1)
+        if #nearby == 0 then
+            location_anomaly = 1
+        end
+    end
+    redis.call('GEOADD', KEYS[4], ARGV[6], ARGV[7], ARGV[8])
+    redis.call('EXPIRE', KEYS[4], 2592000)
+end
+return {count, stats[1], stats[2], location_anomaly}
+"""
+record_transaction = redis_client.register_script(RECORD_TRANSACTION_LUA)
+
+MAX_BATCH_SIZE = 1000
+VELOCITY_WINDOW_SECONDS = 3600.0
+
+# Short-lived per-process cache of stored transaction counts for the read-only
+# risk score lookups, so bursts of requests for one user skip Redis.
+# Entries are dropped whenever that user records a transaction.
+transaction_count_cache = TTLCache(maxsize=100_000, ttl=2.0)
+transaction_count_lock = threading.Lock()
+
+def read_json():
+    # Parsed request body, or None when it is empty or not valid JSON
+    try:
+        return orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        return None
+
+def json_response(data, status=200):
+    return app.response_class(orjson.dumps(data), status=status, mimetype='application/json')
+
+def transaction_error(transaction_data):
+    # Why a transaction can't be recorded and scored, or None when it can
+    if not isinstance(transaction_data, dict):
+        return 'Invalid transaction data provided'
+    amount = transaction_data.get('amount', 0)
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)):
+        return 'Transaction amount must be a number'
+    # User ids key both Redis and the count cache, which /risk-score reads by string
+    user_id = transaction_data.get('fromUser')
+    if user_id is not None and not isinstance(user_id, str):
+        return 'Transaction fromUser must be a string'
+    if 'timestamp' in transaction_data and parse_timestamp(transaction_data['timestamp']) is None:
+        return 'Transaction timestamp must be an ISO 8601 string'
+    return None
+
+def transaction_record(transaction, now_ts):
+    # Keys and args for record_transaction, or None when there is no user to track
+    user_id = transaction.user_id
+    if not user_id:
+        return None
+    
+    # Only the score is ever read back, so the member just needs to be unique.
+    # It is generated here rather than taken from the client so a reused id
+    # can't collapse entries and dodge the velocity count.
+    tx_id = uuid.uuid4().hex
+    
+    keys = [
+        f"user_transactions:{user_id}",
+        f"user_amount_stats:{user_id}",
+        f"user_history:{user_id}",
+        f"user_locations:{user_id}"
+    ]
+    args = [
+        now_ts,
+        now_ts - VELOCITY_WINDOW_SECONDS,
+        transaction.amount,
+        tx_id,
+        msgpack.packb(transaction.data)
+    ]
+    
+    if transaction.coordinates:
+        longitude, latitude = transaction.coordinates
+        # Members are ~1km grid cells so repeat visits don't grow the set
+        member = f"{latitude:.2f},{longitude:.2f}"
+        args += [longitude, latitude, member, LOCATION_RADIUS_KM]
+    else:
+        args += ['', '', '', '']
+    return keys, args
+
+def wants_explanation():
+    # Alert details are only built when the client asks for them with ?explain=1
+    return request.args.get('explain', '').lower() in ('1', 'true')
+
+def score_transaction(transaction, context, now_ts, explain):
+    if explain:
+        return detector.analyze_transaction(transaction, context, now_ts)
+    return {
+        'risk_score': detector.score_only(transaction, context),
+        'timestamp': now_iso(now_ts)
+    }
+
+def get_transaction_counts(user_ids):
+    # Stored transaction counts per user, fetching cache misses in one round-trip
+    with transaction_count_lock:
+        counts = {user_id: transaction_count_cache.get(user_id) for user_id in user_ids}
+    
+    missing = [user_id for user_id, count in counts.items() if count is None]
+    if missing:
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id in missing:
+            pipe.zcard(f"user_transactions:{user_id}")
+        fetched = dict(zip(missing, pipe.execute()))
+        with transaction_count_lock:
+            transaction_count_cache.update(fetched)
+        counts.update(fetched)
+    
+    return counts
+
+def user_risk_score(user_id, recent_count):
+    base_score = min(recent_count * 2, 50)  # Base score from activity
+    
+    # Add randomization for demo
+    risk_score = base_score + random.randint(0, 19)
+    
+    return {
+        'user_id': user_id,
+        'risk_score': min(risk_score, 100),
+        'factors': {
+            'transaction_frequency': recent_count,
+            'base_score': base_score
+        }
+    }
+
+def invalidate_transaction_counts(transactions):
+    with transaction_count_lock:
+        for transaction in transactions:
+            transaction_count_cache.pop(transaction.user_id, None)
+
+def make_context(record_result):
+    recent_count, amount_sum, amount_count, location_anomaly = record_result
+    # Running mean of every amount the user has recorded
+    historical_avg = float(amount_sum) / int(amount_count) if amount_count else None
+    return {
+        'recent_count': recent_count,
+        'historical_avg': historical_avg,
+        'location_anomaly': bool(location_anomaly)
+    }
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({'status': 'OK', 'service': 'fraud-detection'})
+    return json_response({'status': 'OK', 'service': 'fraud-detection'})
 
 @app.route('/analyze', methods=['POST'])
 def analyze_transaction():
     try:
-        transaction_data = request.json
+        transaction_data = read_json()
         
         if not transaction_data:
-            return jsonify({'error': 'No transaction data provided'}), 400
-        
-        # Store transaction for velocity analysis
-        user_id = transaction_data.get('fromUser')
-        if user_id:
-            timestamp = datetime.now().timestamp()
-            redis_client.zadd(
-                f"user_transactions:{user_id}",
-                {json.dumps(transaction_data): timestamp}
-            )
-            # Expire old data after 24 hours
-            redis_client.expire(f"user_transactions:{user_id}", 86400)
-            
-            # Update user average amount
-            amount = transaction_data.get('amount', 0)
-            avg_key = f"user_avg_amount:{user_id}"
-            current_avg = redis_client.get(avg_key)
-            if current_avg:
-                new_avg = (float(current_avg) + amount) / 2
-            else:
-                new_avg = amount
-            redis_client.set(avg_key, new_avg, ex=86400 * 30)  # 30 days expiry
+            return json_response({'error': 'No transaction data provided'}, 400)
+        error = transaction_error(transaction_data)
+        if error:
+            return json_response({'error': error}, 400)
+        
+        # Resolve the clock and transaction fields once for every check
+        now_ts = time.time()
+        transaction = Transaction(transaction_data, now_ts)
+        
+        # Store transaction for velocity analysis and fetch what the checks need
+        context = {}
+        record = transaction_record(transaction, now_ts)
+        if record:
+            keys, args = record
+            context = make_context(record_transaction(keys=keys, args=args))
+            invalidate_transaction_counts([transaction])
         
         # Analyze transaction
-        analysis_result = detector.analyze_transaction(transaction_data)
+        analysis_result = score_transaction(transaction, context, now_ts, wants_explanation())
         
-        return jsonify(analysis_result)
+        return json_response(analysis_result)
         
     except Exception as e:
         app.logger.error(f"Error analyzing transaction: {str(e)}")
-        return jsonify({'error': 'Internal server error'}), 500
+        return json_response({'error': 'Internal server error'}, 500)
+
+@app.route('/analyze-batch', methods=['POST'])
+def analyze_transaction_batch():
+    try:
+        transactions_data = read_json()
+        
+        if not transactions_data or not isinstance(transactions_data, list):
+            return json_response({'error': 'No transactions provided'}, 400)
+        if len(transactions_data) > MAX_BATCH_SIZE:
+            return json_response({'error': f'Batch size exceeds {MAX_BATCH_SIZE} transactions'}, 400)
+        # Validate every item up front, since the pipeline can't be rolled back
+        for index, tx in enumerate(transactions_data):
+            error = transaction_error(tx)
+            if error:
+                return json_response({'error': f'Transaction {index}: {error}'}, 400)
+        
+        now_ts = time.time()
+        explain = wants_explanation()
+        transactions = [Transaction(tx, now_ts) for tx in transactions_data]
+        
+        # Record every transaction in one pipeline. redis-py checks the script
+        # is loaded (SCRIPT EXISTS) first, so the batch costs two round-trips.
+        records = [transaction_record(tx, now_ts) for tx in transactions]
+        pipe = redis_client.pipeline(transaction=False)
+        for record in records:
+            if record:
+                keys, args = record
+                record_transaction(keys=keys, args=args, client=pipe)
+        record_results = iter(pipe.execute())
+        invalidate_transaction_counts(transactions)
+        
+        results = []
+        for tx, record in zip(transactions, records):
+            context = make_context(next(record_results)) if record else {}
+            results.append(score_transaction(tx, context, now_ts, explain))
+        
+        return json_response({'results': results})
+        
+    except Exception as e:
+        app.logger.error(f"Error analyzing transaction batch: {str(e)}")
+        return json_response({'error': 'Internal server error'}, 500)
 
 @app.route('/risk-score/<user_id>', methods=['GET'])
 def get_user_risk_score(user_id):
     try:
         # Calculate user risk score based on recent activity
-        recent_key = f"user_transactions:{user_id}"
-        recent_count = redis_client.zcard(recent_key)
+        recent_count = get_transaction_counts([user_id])[user_id]
         
-        base_score = min(recent_count * 2, 50)  # Base score from activity
+        return json_response(user_risk_score(user_id, recent_count))
         
-        # Add randomization for demo
-        risk_score = base_score + np.random.randint(0, 20)
+    except Exception as e:
+        app.logger.error(f"Error calculating risk score: {str(e)}")
+        return json_response({'error': 'Internal server error'}, 500)
+
+@app.route('/risk-scores', methods=['POST'])
+def get_user_risk_scores():
+    try:
+        data = read_json()
+        user_ids = data.get('user_ids') if isinstance(data, dict) else None
         
-        return jsonify({
-            'user_id': user_id,
-            'risk_score': min(risk_score, 100),
-            'factors': {
-                'transaction_frequency': recent_count,
-                'base_score': base_score
-            }
+        if not user_ids or not isinstance(user_ids, list):
+            return json_response({'error': 'No user ids provided'}, 400)
+        if len(user_ids) > MAX_BATCH_SIZE:
+            return json_response({'error': f'Batch size exceeds {MAX_BATCH_SIZE} user ids'}, 400)
+        if not all(isinstance(user_id, str) for user_id in user_ids):
+            return json_response({'error': 'Invalid user ids provided'}, 400)
+        
+        # Calculate every user's risk score from a single round-trip
+        counts = get_transaction_counts(user_ids)
+        
+        return json_response({
+            'results': [user_risk_score(user_id, counts[user_id]) for user_id in user_ids]
         })
         
     except Exception as e:
-        app.logger.error(f"Error calculating risk score: {str(e)}")
-        return jsonify({'error': 'Internal server error'}), 500
+        app.logger.error(f"Error calculating risk scores: {str(e)}")
+        return json_response({'error': 'Internal server error'}, 500)
 
 if __name__=='__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file